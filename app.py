@@ -1,8 +1,17 @@
 import streamlit as st
 from PIL import Image
 import google.generativeai as genai
-from gtts import gTTS
-import tempfile, base64, requests
+from gtts import gTTS, gTTSError
+from google.api_core import exceptions as gexc
+from googleapiclient.errors import HttpError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+import tempfile, requests, hashlib, io, os, re
+import diskcache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Attempt to import the JS helper
 try:
@@ -22,10 +31,66 @@ except Exception as e:
     st.error("Missing or invalid secrets. Make sure GEMINI_API_KEY and WEATHER_API_KEY are in .streamlit/secrets.toml")
     st.stop()
 
+LANGUAGES = MappingProxyType({"English":"en","Hindi":"hi","Marathi":"mr","Spanish":"es","French":"fr","German":"de","Tamil":"ta","Telugu":"te"})
+
+PROMPT_TMPL = """
+You are a Smart Dermatology Assistant. Analyze the provided skin image.
+
+User: {user_name}
+Current Environment: {weather}
+
+Give analysis considering how weather (temperature, humidity, sun, pollution) can affect skin conditions.
+Respond in English.
+Use this format:
+
+---
+**Disease Name:** [Likely condition]
+
+**Severity Level:** [Mild/Moderate/Severe]
+
+**Description:** [2 paragraphs about disease, symptoms, and how weather may worsen/improve it]
+
+**Precautions/Recommendations:** 
+- At least 3-4 tips, including weather-related care.
+- Add a disclaimer: Not a substitute for professional medical diagnosis.
+---
+"""
+
+TRANSLATE_TMPL = """
+Translate the following part of a dermatology report into {language}.
+Keep the Markdown formatting and structure exactly as it is. Output only the translation.
+
+{text}
+"""
+
+@st.cache_resource
+def get_session():
+    # One pooled Session shared across reruns/users so repeat calls skip the TCP+TLS handshake
+    session = requests.Session()
+    # Retry transient failures (timeouts, connection resets, 429/5xx) with exponential backoff.
+    # Retry-After is ignored so a single response can't stall the script thread for long.
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+SESSION = get_session()
+
+@st.cache_resource
+def get_disk_cache():
+    # On-disk so Gemini and TTS results survive Streamlit restarts and redeploys.
+    # Holds user names and diagnoses, so the directory is private to the app's user.
+    path = os.path.join(tempfile.gettempdir(), "derm_cache")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+    return diskcache.Cache(path, size_limit=int(5e8))
+
+CACHE = get_disk_cache()
+
 def ipinfo_fallback():
     try:
         url = f"https://ipinfo.io/json?token={IPINFO_TOKEN}" if IPINFO_TOKEN else "https://ipinfo.io/json"
-        r = requests.get(url, timeout=5)
+        r = SESSION.get(url, timeout=5)
         if r.status_code == 200:
             data = r.json()
             loc = data.get("loc")
@@ -55,64 +120,277 @@ def fetch_coords_browser():
     except Exception:
         return None
 
-def get_weather(lat, lon):
+@st.cache_data(ttl=600, show_spinner=False)
+def _fetch_weather(lat: float, lon: float) -> str:
+    # Raises on failure so errors are not cached for the full TTL
+    url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={WEATHER_KEY}&units=metric"
+    r = SESSION.get(url, timeout=6)
+    data = r.json()
+    weather = data["weather"][0]["description"].capitalize()
+    temp = data["main"]["temp"]
+    humidity = data["main"]["humidity"]
+    return f"Weather: {weather}, Temp: {temp}°C, Humidity: {humidity}%"
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_weather(lat: float, lon: float) -> str:
+    # Holds "unavailable" briefly so an outage doesn't block every rerun on retries
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={WEATHER_KEY}&units=metric"
-        r = requests.get(url, timeout=6)
-        data = r.json()
-        weather = data["weather"][0]["description"].capitalize()
-        temp = data["main"]["temp"]
-        humidity = data["main"]["humidity"]
-        return f"Weather: {weather}, Temp: {temp}°C, Humidity: {humidity}%"
+        return _fetch_weather(lat, lon)
     except Exception:
         return "Weather data unavailable"
 
-def analyze_skin_image(image: Image.Image, user_name: str, language: str, weather: str):
-    prompt = f"""
-You are a Smart Dermatology Assistant. Analyze the provided skin image.
+def _retrying(predicate):
+    # Shared backoff for every retried call; only errors matching predicate are retried
+    return retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=0.3, max=2),
+        retry=retry_if_exception(predicate),
+        reraise=True,
+    )
 
-User: {user_name}
-Current Environment: {weather}
+def _gemini_retryable(e: BaseException) -> bool:
+    # Rate limits and temporary unavailability
+    return isinstance(e, (gexc.ResourceExhausted, gexc.ServiceUnavailable))
 
-Give analysis considering how weather (temperature, humidity, sun, pollution) can affect skin conditions.
-Translate entire response into {language}.
-Use this format:
+def _tts_retryable(e: BaseException) -> bool:
+    # gTTS wraps network errors without a response; those and 429/5xx are transient
+    if not isinstance(e, gTTSError):
+        return False
+    rsp = getattr(e, "rsp", None)
+    return rsp is None or rsp.status_code == 429 or rsp.status_code >= 500
 
----
-**Disease Name:** [Likely condition]
+def _upload_retryable(e: BaseException) -> bool:
+    # The Files API goes through the discovery client, which raises HttpError rather than api_core errors,
+    # and lets socket timeouts and connection resets through as-is
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    return isinstance(e, HttpError) and e.resp.status in (429, 500, 503)
 
-**Severity Level:** [Mild/Moderate/Severe]
+GEMINI_RETRY = _retrying(_gemini_retryable)
+UPLOAD_RETRY = _retrying(_upload_retryable)
+TTS_RETRY = _retrying(_tts_retryable)
 
-**Description:** [2 paragraphs about disease, symptoms, and how weather may worsen/improve it]
+@GEMINI_RETRY
+def _generate(model, contents, stream: bool = True):
+    return model.generate_content(contents, stream=stream)
 
-**Precautions/Recommendations:** 
-- At least 3-4 tips, including weather-related care.
-- Add a disclaimer: Not a substitute for professional medical diagnosis.
----
-"""
-    model = genai.GenerativeModel("gemini-2.5-flash")
-    response = model.generate_content([image, prompt])
-    return response.text
+MAX_IMAGE_SIDE = 1024
+
+def downscale(image: Image.Image) -> Image.Image:
+    # Nothing above ~1024px helps classification; it only inflates upload and prefill cost
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    return image
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def load_image(file_bytes: bytes) -> Image.Image:
+    # Skip the PIL decode, colour convert and resize on widget-driven reruns
+    return downscale(Image.open(io.BytesIO(file_bytes)).convert("RGB"))
+
+@UPLOAD_RETRY
+def _upload_image(image: Image.Image):
+    # Takes the already downscaled load_image result; only the JPEG encode happens here
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
+        image.save(tmp, format="JPEG", quality=85, optimize=True)
+    try:
+        return genai.upload_file(path=tmp.name, mime_type="image/jpeg")
+    finally:
+        os.remove(tmp.name)
+
+def delete_gemini_file():
+    # Don't leave copies of medical photos on Google's side until the 48h expiry
+    handle = st.session_state.get("gemini_file")
+    if handle is not None:
+        try:
+            genai.delete_file(handle.name)
+        except Exception:
+            pass
+    st.session_state.gemini_file = None
+    st.session_state.gemini_file_hash = None
+
+def get_gemini_file(image_bytes: bytes, img_hash: str):
+    # Upload each image once per session via the Files API and reuse the handle on re-analysis
+    if st.session_state.get("gemini_file_hash") != img_hash:
+        delete_gemini_file()
+        st.session_state.gemini_file = _upload_image(load_image(image_bytes))
+        st.session_state.gemini_file_hash = img_hash
+    return st.session_state.gemini_file
 
-def speak_text(text: str, language: str):
+@st.cache_resource
+def get_model():
+    return genai.GenerativeModel("gemini-2.5-flash")
+
+@st.cache_resource
+def get_translate_model():
+    # Text-only translation does not need the vision model
+    return genai.GenerativeModel("gemini-2.5-flash-lite")
+
+ANALYSIS_TTL = 3600
+
+class AnalysisBlocked(Exception):
+    pass
+
+def _block_reason(response) -> str:
+    # Name why Gemini produced no text: a blocked prompt, or a candidate that stopped early (e.g. SAFETY)
+    if response is None:
+        return "empty response"
+    feedback = response.prompt_feedback
+    if feedback and feedback.block_reason:
+        return f"prompt blocked: {getattr(feedback.block_reason, 'name', feedback.block_reason)}"
+    if response.candidates:
+        reason = response.candidates[0].finish_reason
+        return f"finish reason: {getattr(reason, 'name', reason)}"
+    return "empty response"
+
+def _cached_stream(key: tuple, make_stream):
+    hit = CACHE.get(key)
+    if hit is not None:
+        yield hit
+        return
+
+    buf = []
+    chunk = None
+    for chunk in make_stream():
+        # Trailing chunks may carry only a finish reason or metadata, and .text raises on those
+        if chunk.candidates and chunk.parts and chunk.text:
+            buf.append(chunk.text)
+            yield chunk.text
+    if not buf:
+        raise AnalysisBlocked(_block_reason(chunk))
+
+    # Only complete, non-empty responses are cached
+    text = "".join(buf)
+    if text:
+        CACHE.set(key, text, expire=ANALYSIS_TTL)
+
+def _analysis_key(img_hash: str, user_name: str, weather: str) -> tuple:
+    return ("en", img_hash, user_name, weather)
+
+def _analyze_en(image_bytes: bytes, img_hash: str, user_name: str, weather: str):
+    def make_stream():
+        file_handle = get_gemini_file(image_bytes, img_hash)
+        prompt = PROMPT_TMPL.format(user_name=user_name, weather=weather)
+        return _generate(get_model(), [file_handle, prompt])
     try:
-        tts = gTTS(text=text, lang=language)
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        tts.save(tmp.name)
-        with open(tmp.name, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-        return tmp.name, b64
+        yield from _cached_stream(_analysis_key(img_hash, user_name, weather), make_stream)
+    finally:
+        # Once the report is cached (or the call failed) the uploaded photo is no longer needed
+        delete_gemini_file()
+
+def _translation_key(en_text: str, language: str) -> tuple:
+    return ("translate", hashlib.sha256(en_text.encode()).hexdigest(), language)
+
+@st.cache_resource
+def get_translate_executor():
+    return ThreadPoolExecutor(max_workers=8)
+
+def _translate_paragraph(model, paragraph: str, language: str) -> str:
+    # Separators such as "---" have nothing to translate
+    if not any(ch.isalnum() for ch in paragraph):
+        return paragraph
+    prompt = TRANSLATE_TMPL.format(language=language, text=paragraph)
+    response = _generate(model, prompt, stream=False)
+    if not (response.candidates and response.parts):
+        raise AnalysisBlocked(_block_reason(response))
+    return response.text.strip()
+
+def _translate(en_stream, language: str):
+    # Translate each paragraph as soon as the English stream completes it. The translations run
+    # concurrently and are yielded in order, so the first one shows up without waiting for the
+    # whole vision generation and the rest don't queue behind each other.
+    model, executor = get_translate_model(), get_translate_executor()
+    en_buf, out, pending = [], [], ""
+    futures = deque()
+
+    def drain(block: bool):
+        while futures and (block or futures[0][0].done()):
+            future, sep = futures.popleft()
+            out.append(future.result() + sep)
+            yield out[-1]
+
+    for chunk in en_stream:
+        en_buf.append(chunk)
+        *paragraphs, pending = (pending + chunk).split("\n\n")
+        for paragraph in paragraphs:
+            futures.append((executor.submit(_translate_paragraph, model, paragraph, language), "\n\n"))
+        yield from drain(block=False)
+    futures.append((executor.submit(_translate_paragraph, model, pending, language), ""))
+    yield from drain(block=True)
+
+    # Only complete, non-empty translations are cached
+    translation = "".join(out)
+    if translation.strip():
+        CACHE.set(_translation_key("".join(en_buf), language), translation, expire=ANALYSIS_TTL)
+
+def analyze_skin_image(image_bytes: bytes, img_hash: str, user_name: str, language: str, weather: str):
+    # The vision inference runs once per image in English; other languages only pay for a text translation
+    if language == "English":
+        yield from _analyze_en(image_bytes, img_hash, user_name, weather)
+        return
+    en_text = CACHE.get(_analysis_key(img_hash, user_name, weather))
+    if en_text is not None:
+        hit = CACHE.get(_translation_key(en_text, language))
+        if hit is not None:
+            yield hit
+            return
+    yield from _translate(_analyze_en(image_bytes, img_hash, user_name, weather), language)
+
+@TTS_RETRY
+def _render_tts(text: str, lang: str) -> bytes:
+    buf = io.BytesIO()
+    gTTS(text=text, lang=lang).write_to_fp(buf)
+    return buf.getvalue()
+
+TTS_TTL = 86400
+
+def _tts_bytes(text: str, lang: str) -> bytes:
+    # gTTS output is deterministic for (text, lang); render in memory, no temp file
+    key = ("tts", hashlib.sha256(text.encode()).hexdigest(), lang)
+    mp3 = CACHE.get(key)
+    if mp3 is None:
+        mp3 = _render_tts(text, lang)
+        CACHE.set(key, mp3, expire=TTS_TTL)
+    return mp3
+
+@st.cache_resource
+def get_tts_executor():
+    # Kept apart from other work so a long report's gTTS jobs only queue behind each other
+    return ThreadPoolExecutor(max_workers=4)
+
+# Includes the Devanagari danda so Hindi and Marathi reports are also voiced sentence by sentence
+SENTENCE_END = re.compile(r"(?<=[.!?।])\s+|\n+")
+
+def submit_tts(pending: str, language: str, parts: list, final: bool = False) -> str:
+    # Hand every complete sentence to gTTS in the background while Gemini keeps streaming.
+    # Splitting by a fixed rule keeps the TTS cache keys identical whether the text streamed
+    # in or was replayed in one piece from the analysis cache. Returns the unfinished tail.
+    if final:
+        done, rest = pending, ""
+    else:
+        ends = list(SENTENCE_END.finditer(pending))
+        if not ends:
+            return pending
+        done, rest = pending[:ends[-1].start()], pending[ends[-1].end():]
+    for sentence in SENTENCE_END.split(done):
+        sentence = sentence.strip()
+        # gTTS rejects text with nothing speakable (e.g. a lone "---")
+        if any(ch.isalnum() for ch in sentence):
+            parts.append(get_tts_executor().submit(_tts_bytes, sentence, language))
+    return rest
+
+def speak_text(parts: list):
+    # MP3 frames concatenate cleanly, so the per-sentence clips are stitched in order
+    try:
+        return b"".join(f.result() for f in parts) or None
     except Exception as e:
         st.error(f"TTS error: {e}")
-        return None, None
+        return None
 
 # UI
 st.title("🌤️ Smart Dermatology Assistant — Auto Location (Enable Location)")
 
 user_name = st.text_input("Enter your name:", placeholder="e.g., Alex")
-languages = {"English":"en","Hindi":"hi","Marathi":"mr","Spanish":"es","French":"fr","German":"de","Tamil":"ta","Telugu":"te"}
-chosen_language = st.selectbox("Choose language:", list(languages.keys()))
-lang_code = languages[chosen_language]
+chosen_language = st.selectbox("Choose language:", list(LANGUAGES.keys()))
+lang_code = LANGUAGES[chosen_language]
 
 st.divider()
 
@@ -197,40 +475,57 @@ if not st.session_state.coords:
             else:
                 st.error("IP-based location failed. Please enter coordinates manually below.")
     st.markdown("**Or enter coordinates manually:**")
-    lat_manual = st.number_input("Latitude", format="%.6f", key="lat_manual")
-    lon_manual = st.number_input("Longitude", format="%.6f", key="lon_manual")
-    if st.button("Use manual coordinates"):
+    # A form batches the inputs so the script reruns once on submit, not on every edit
+    with st.form("manual_coords"):
+        lat_manual = st.number_input("Latitude", format="%.6f", key="lat_manual")
+        lon_manual = st.number_input("Longitude", format="%.6f", key="lon_manual")
+        submitted = st.form_submit_button("Use manual coordinates")
+    if submitted:
         st.session_state.coords = (lat_manual, lon_manual)
         st.success(f"Using manual coordinates: {lat_manual:.6f}, {lon_manual:.6f}")
 
 # If we have coordinates, proceed to weather and analysis UI
 if st.session_state.coords:
     lat, lon = st.session_state.coords
-    weather_info = get_weather(lat, lon)
+    weather_info = get_weather(round(lat, 3), round(lon, 3))
     st.info(f"📍 Location Weather: {weather_info}")
 
     uploaded_file = st.file_uploader("Upload skin image", type=["jpg","jpeg","png"])
     if uploaded_file:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Uploaded Skin Image", use_column_width=True)
+        image_bytes = uploaded_file.getvalue()
+        img_hash = hashlib.sha256(image_bytes).hexdigest()
+        image = load_image(image_bytes)
+        # The browser only needs a column-sized preview, not the full analysis image
+        display_img = image.copy()
+        display_img.thumbnail((768, 768))
+        st.image(display_img, caption="Uploaded Skin Image")
 
         if st.button("🔬 Analyze with Weather"):
             if not user_name:
                 st.warning("Enter your name first.")
             else:
-                with st.spinner("Analyzing..."):
-                    result = analyze_skin_image(image, user_name, chosen_language, weather_info)
+                # Keep the spinner only until the first chunk arrives, then stream into a placeholder
+                stream = analyze_skin_image(image_bytes, img_hash, user_name, chosen_language, weather_info)
+                tts_parts = []
+                try:
+                    with st.spinner("Analyzing..."):
+                        first = next(stream, "")
+                    placeholder = st.empty()
+                    buf = [first]
+                    placeholder.markdown(first)
+                    pending = submit_tts(first, lang_code, tts_parts)
+                    for c in stream:
+                        buf.append(c)
+                        placeholder.markdown("".join(buf))
+                        pending = submit_tts(pending + c, lang_code, tts_parts)
+                except AnalysisBlocked as e:
+                    st.error(f"Gemini returned no analysis ({e}). Try a clearer or different photo.")
+                else:
+                    submit_tts(pending, lang_code, tts_parts, final=True)
                     st.success("✅ Analysis Complete!")
-                    st.markdown(result)
-
-                    audio_path, b64_audio = speak_text(result, lang_code)
-                    if audio_path:
-                        st.audio(audio_path, format="audio/mp3")
-                        st.markdown(
-                            f"""<audio autoplay>
-                                <source src="data:audio/mp3;base64,{b64_audio}" type="audio/mp3">
-                            </audio>""",
-                            unsafe_allow_html=True
-                        )
+
+                    mp3_bytes = speak_text(tts_parts)
+                    if mp3_bytes:
+                        st.audio(mp3_bytes, format="audio/mp3", autoplay=True)
 
 st.markdown("<hr><p style='text-align:center;color:gray;'>*Disclaimer: AI tool. Not a medical substitute.*</p>", unsafe_allow_html=True)